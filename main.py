@@ -1,19 +1,122 @@
+import asyncio
+import hashlib
 import os
-from fastapi import FastAPI, Query
+from contextlib import asynccontextmanager
+from urllib.parse import quote_plus
+import backoff
+from aiolimiter import AsyncLimiter
+from async_lru import alru_cache
+from fastapi import FastAPI, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import requests
-from typing import List, Dict, Any
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+import httpx
+import orjson
+from typing import List, Dict, Any, Optional
 
-app = FastAPI()
+
+class AIMDSemaphore:
+    """Semaphore for outbound calls whose capacity adapts AIMD-style:
+    halved when upstream signals pressure (429/5xx), grown by one per
+    10 clean calls up to a cap. Keeps us from exhausting sockets under
+    load while still probing for headroom when the upstream is healthy.
+    """
+
+    def __init__(self, initial: int = 64, floor: int = 4, cap: int = 128):
+        self._sem = asyncio.Semaphore(initial)
+        self._limit = initial
+        self._floor = floor
+        self._cap = cap
+        self._debt = 0  # permits to swallow instead of releasing after a shrink
+        self._successes = 0
+
+    async def __aenter__(self):
+        await self._sem.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._grow()
+        elif isinstance(exc, httpx.HTTPStatusError) and (
+            exc.response.status_code == 429 or exc.response.status_code >= 500
+        ):
+            self._shrink()
+        if self._debt > 0:
+            self._debt -= 1
+        else:
+            self._sem.release()
+
+    def _shrink(self):
+        new_limit = max(self._floor, self._limit // 2)
+        self._debt += self._limit - new_limit
+        self._limit = new_limit
+        self._successes = 0
+
+    def _grow(self):
+        self._successes += 1
+        if self._successes >= 10 and self._limit < self._cap:
+            self._successes = 0
+            self._limit += 1
+            if self._debt > 0:
+                self._debt -= 1
+            else:
+                self._sem.release()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared HTTP client so upstream calls reuse connections and TLS
+    # sessions instead of paying the handshake on every request; HTTP/2
+    # lets one connection multiplex concurrent Commons + Wikipedia calls
+    app.state.http = httpx.AsyncClient(
+        timeout=12,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=32,
+            keepalive_expiry=60,
+        ),
+    )
+    # Token buckets per upstream host: smooth our outbound rate well below
+    # Wikimedia's guideline so bursts don't trigger 429 storms
+    app.state.limiters = {
+        "en.wikipedia.org": AsyncLimiter(max_rate=50, time_period=1),
+        "commons.wikimedia.org": AsyncLimiter(max_rate=50, time_period=1),
+    }
+    # Cap total in-flight upstream calls; adapts down on 429/5xx
+    app.state.out_sem = AIMDSemaphore(initial=64, floor=4, cap=128)
+    yield
+    await app.state.http.aclose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Import the database module once at startup instead of per request; a
+# missing module surfaces here rather than being re-discovered on every hit
+try:
+    from database import db
+    _db_module_available = True
+except ImportError:
+    db = None
+    _db_module_available = False
+
+# Explicit origins let simple GETs skip the preflight round trip entirely
+# ("*" with credentials is an invalid CORS combo anyway); preflights that
+# do happen are cached client-side for a day
+_allowed_origins = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "*").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=_allowed_origins,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,
 )
 
+# /images payloads are 20-80KB of highly compressible JSON; don't bother
+# compressing tiny responses like /api/hello
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 @app.get("/")
 def read_root():
     return {"message": "Hello from FastAPI Backend!"}
@@ -22,8 +125,15 @@ def read_root():
 def hello():
     return {"message": "Hello from the backend API!"}
 
+@alru_cache(maxsize=1, ttl=30)
+async def _list_collections() -> List[str]:
+    """Collection names barely change; cache them briefly and keep the
+    blocking PyMongo call off the event loop."""
+    return await asyncio.to_thread(db.list_collection_names)
+
+
 @app.get("/test")
-def test_database():
+async def test_database():
     """Test endpoint to check if database is available and accessible"""
     response = {
         "backend": "✅ Running",
@@ -33,42 +143,68 @@ def test_database():
         "connection_status": "Not Connected",
         "collections": []
     }
-    
+
     try:
-        # Try to import database module
-        from database import db
-        
-        if db is not None:
+        if not _db_module_available:
+            response["database"] = "❌ Database module not found (run enable-database first)"
+        elif db is not None:
             response["database"] = "✅ Available"
             response["database_url"] = "✅ Configured"
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
-            
+
             # Try to list collections to verify connectivity
             try:
-                collections = db.list_collection_names()
+                collections = await _list_collections()
                 response["collections"] = collections[:10]  # Show first 10 collections
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
                 response["database"] = f"⚠️  Connected but Error: {str(e)[:50]}"
         else:
             response["database"] = "⚠️  Available but not initialized"
-            
-    except ImportError:
-        response["database"] = "❌ Database module not found (run enable-database first)"
+
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
     
     # Check environment variables
-    import os
     response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
     response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
     
     return response
 
 
-def search_commons_images(query: str, limit: int) -> List[Dict[str, Any]]:
-    """Use Wikimedia Commons to fetch image files directly relevant to the query."""
+def _giveup(exc: Exception) -> bool:
+    """Only retry 429s, 5xx and connection errors; other 4xx won't improve."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status != 429 and status < 500
+    return False
+
+
+async def _check_response(r: httpx.Response) -> None:
+    """Honor Retry-After on 429s, then raise so backoff can retry the call."""
+    if r.status_code == 429:
+        retry_after = r.headers.get("Retry-After")
+        if retry_after:
+            try:
+                # Cap the pause so total wait stays inside the 12s timeout budget
+                await asyncio.sleep(min(float(retry_after), 4.0))
+            except ValueError:
+                pass
+    r.raise_for_status()
+
+
+@backoff.on_exception(backoff.expo, httpx.HTTPError, max_tries=4, max_time=8,
+                      jitter=backoff.full_jitter, giveup=_giveup)
+async def search_commons_images(query: str, limit: int, client: httpx.AsyncClient) -> List[Dict[str, Any]]:
+    """Use Wikimedia Commons to fetch image files directly relevant to the query.
+
+    The generator=search flow already returns up to 50 results per HTTP
+    call. Keep it that way: any future per-file enrichment (license
+    details, captions, ...) should batch with a single pipe-separated
+    ``titles=File:A|File:B|...`` query (max 50) rather than one request
+    per file.
+    """
     api = "https://commons.wikimedia.org/w/api.php"
     params = {
         "action": "query",
@@ -80,12 +216,20 @@ def search_commons_images(query: str, limit: int) -> List[Dict[str, Any]]:
         "gsrlimit": min(limit, 50),
         "prop": "imageinfo|info",
         "iiprop": "url|extmetadata",
+        # Only the Artist key is read from extmetadata; filtering server-side
+        # shrinks the payload by an order of magnitude
+        "iiextmetadatafilter": "Artist",
+        "iiextmetadatalanguage": "en",
         "iiurlwidth": 800,
         "inprop": "url",
     }
-    r = requests.get(api, params=params, timeout=12)
-    r.raise_for_status()
-    data = r.json()
+    async with app.state.out_sem, app.state.limiters["commons.wikimedia.org"]:
+        # Stream the body so we don't hold response bytes twice, and ask for
+        # gzip so text-heavy JSON crosses the wire compressed
+        async with client.stream("GET", api, params=params, headers={"Accept-Encoding": "gzip"}) as r:
+            await _check_response(r)
+            body = await r.aread()
+    data = orjson.loads(body)
     pages = data.get("query", {}).get("pages", {})
     items: List[Dict[str, Any]] = []
     for pageid, page in pages.items():
@@ -97,7 +241,7 @@ def search_commons_images(query: str, limit: int) -> List[Dict[str, Any]]:
         desc_url = page.get("fullurl") or f"https://commons.wikimedia.org/wiki/{title.replace(' ', '_')}"
         summary = None
         extmeta = imageinfo.get("extmetadata") or {}
-        artist = (extmeta.get("Artist") or {}).get("value")
+        artist = extmeta.get("Artist", {}).get("value")
         if artist:
             summary = f"By {artist}"
         items.append({
@@ -110,7 +254,9 @@ def search_commons_images(query: str, limit: int) -> List[Dict[str, Any]]:
     return items
 
 
-def search_wikipedia_pages(query: str, limit: int) -> List[Dict[str, Any]]:
+@backoff.on_exception(backoff.expo, httpx.HTTPError, max_tries=4, max_time=8,
+                      jitter=backoff.full_jitter, giveup=_giveup)
+async def search_wikipedia_pages(query: str, limit: int, client: httpx.AsyncClient) -> List[Dict[str, Any]]:
     """Fallback: search Wikipedia pages with thumbnails."""
     api_url = "https://en.wikipedia.org/w/api.php"
     params = {
@@ -128,13 +274,20 @@ def search_wikipedia_pages(query: str, limit: int) -> List[Dict[str, Any]]:
         "exsentences": 1,
         "inprop": "url",
     }
-    r = requests.get(api_url, params=params, timeout=12)
-    r.raise_for_status()
-    data = r.json()
+    async with app.state.out_sem, app.state.limiters["en.wikipedia.org"]:
+        async with client.stream("GET", api_url, params=params, headers={"Accept-Encoding": "gzip"}) as r:
+            await _check_response(r)
+            body = await r.aread()
+    data = orjson.loads(body)
     pages = data.get("query", {}).get("pages", {})
     items: List[Dict[str, Any]] = []
     for pageid, page in pages.items():
-        thumb = page.get("thumbnail", {}).get("source")
+        # Most pages have a thumbnail; try/except skips the intermediate
+        # dict allocation of a .get({}).get() chain on the hot path
+        try:
+            thumb = page["thumbnail"]["source"]
+        except KeyError:
+            continue
         if not thumb:
             continue
         title = page.get("title")
@@ -150,56 +303,128 @@ def search_wikipedia_pages(query: str, limit: int) -> List[Dict[str, Any]]:
     return items
 
 
-@app.get("/images")
-def get_images(query: str = Query(..., min_length=1, description="Search prompt"), limit: int = Query(24, ge=1, le=50)) -> Dict[str, Any]:
-    """
-    Search for images relevant to a prompt using Wikimedia Commons first (direct media),
-    then fall back to Wikipedia page thumbnails. Only if both fail, return placeholders.
+# Shared skeleton for placeholder items; only the per-item fields are
+# filled in per request, so the hot error/empty paths allocate less
+_PLACEHOLDER_TEMPLATE = {
+    "pageUrl": "https://picsum.photos/",
+    "source": "picsum",
+}
+
+# Precompiled seed-URL template; the query is percent-encoded once per
+# call instead of interpolated raw into every item's URL
+_PLACEHOLDER_URL = "https://picsum.photos/seed/{q}-{i}/800/600"
+
+
+def _placeholders(query: str, n: int, summary: str) -> List[Dict[str, Any]]:
+    """Build n placeholder items by specializing the shared template."""
+    qs = quote_plus(query)
+    return [
+        dict(
+            _PLACEHOLDER_TEMPLATE,
+            title=f"Placeholder #{i+1}",
+            thumbnail=_PLACEHOLDER_URL.format(q=qs, i=i),
+            summary=summary,
+        )
+        for i in range(n)
+    ]
+
+
+# Repeat queries (autocomplete, retries, pagination) are common, so cache
+# results in-process for a few minutes instead of re-hitting Wikimedia.
+# alru_cache stores the in-flight task itself, so N concurrent requests
+# for the same (query, limit) coalesce into a single upstream fetch
+# (singleflight) rather than racing duplicate calls.
+IMAGES_CACHE_TTL = 300
+
+# Let browsers/CDNs serve repeats themselves for the same window
+_CACHE_CONTROL = "public, max-age=300, stale-while-revalidate=60"
+
+
+def _cacheable_json(request: Request, body: bytes, headers: Optional[Dict[str, str]] = None) -> Response:
+    """Wrap serialized JSON with ETag/Cache-Control headers, answering
+    conditional requests with an empty 304 instead of the full body."""
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": _CACHE_CONTROL})
+    all_headers = {"ETag": etag, "Cache-Control": _CACHE_CONTROL}
+    if headers:
+        all_headers.update(headers)
+    return Response(content=body, media_type="application/json", headers=all_headers)
+
+
+@alru_cache(maxsize=1024, ttl=IMAGES_CACHE_TTL)
+async def _fetch_images(query: str, limit: int) -> bytes:
+    """Fetch, merge and dedupe upstream results for a normalized query.
+
+    Returns the payload already serialized with orjson: encoding happens
+    once per cache fill, and hits hand out immutable bytes so nothing
+    needs to be copied per request.
     """
+    client = app.state.http
     try:
-        # 1) Wikimedia Commons: returns actual image files for the query
-        items = search_commons_images(query, limit)
-
-        # 2) If too few from Commons, top up with Wikipedia thumbnails
-        if len(items) < limit:
-            wiki_items = search_wikipedia_pages(query, limit)
-            # Avoid duplicates by URL
-            seen = {i["thumbnail"] for i in items}
-            for w in wiki_items:
-                if w["thumbnail"] not in seen and len(items) < limit:
-                    items.append(w)
-                    seen.add(w["thumbnail"])
+        # Fire both upstream searches in parallel: total latency becomes the
+        # max of the two calls instead of their sum. A failure on one side
+        # just means fewer results, not a failed request.
+        commons_task = asyncio.create_task(search_commons_images(query, limit, client))
+        wiki_task = asyncio.create_task(search_wikipedia_pages(query, limit, client))
+        commons_items, wiki_items = await asyncio.gather(commons_task, wiki_task, return_exceptions=True)
+        if isinstance(commons_items, BaseException):
+            commons_items = []
+        if isinstance(wiki_items, BaseException):
+            wiki_items = []
+
+        # Merge with an insertion-ordered dict keyed by thumbnail URL:
+        # Commons results first (direct media), Wikipedia fills the gaps,
+        # and dedupe + truncate fall out of the dict semantics
+        merged = {i["thumbnail"]: i for i in commons_items}
+        for w in wiki_items:
+            merged.setdefault(w["thumbnail"], w)
+        items = list(merged.values())[:limit]
 
         # 3) Final fallback: high-quality placeholders so the UI still shows something
         if not items:
-            items = [
-                {
-                    "title": f"Placeholder #{i+1}",
-                    "thumbnail": f"https://picsum.photos/seed/{query}-{i}/800/600",
-                    "pageUrl": "https://picsum.photos/",
-                    "summary": "Placeholder image while we find results",
-                    "source": "picsum"
-                }
-                for i in range(min(limit, 12))
-            ]
-
-        return {"query": query, "count": len(items), "items": items}
+            items = _placeholders(query, min(limit, 12), "Placeholder image while we find results")
+
+        return orjson.dumps({"query": query, "count": len(items), "items": items})
 
     except Exception as e:
-        fallback = [
-            {
-                "title": f"Placeholder #{i+1}",
-                "thumbnail": f"https://picsum.photos/seed/{query}-{i}/800/600",
-                "pageUrl": "https://picsum.photos/",
-                "summary": "Placeholder image due to an error fetching results",
-                "source": "picsum"
-            }
-            for i in range(6)
-        ]
-        return {"query": query, "count": len(fallback), "items": fallback, "error": str(e)}
+        fallback = _placeholders(query, 6, "Placeholder image due to an error fetching results")
+        return orjson.dumps({"query": query, "count": len(fallback), "items": fallback, "error": str(e)})
+
+
+@app.get("/images")
+async def get_images(request: Request, query: str = Query(..., min_length=1, description="Search prompt"), limit: int = Query(24, ge=1, le=50)) -> Response:
+    """
+    Search for images relevant to a prompt using Wikimedia Commons first (direct media),
+    then fall back to Wikipedia page thumbnails. Only if both fail, return placeholders.
+    """
+    # Collapse whitespace and truncate before doing anything else; degenerate
+    # queries (autocomplete debounce firing on " " or "!!") shouldn't cost
+    # two upstream round trips
+    q = " ".join(query.split())[:200].lower()
+    if len(q) < 2 or not any(ch.isalnum() for ch in q):
+        placeholders = _placeholders(q, min(limit, 12), "Placeholder image while we find results")
+        body = orjson.dumps({"query": query, "count": len(placeholders), "items": placeholders})
+        return _cacheable_json(request, body)
+
+    # Serving the cached bytes directly skips response-model validation and
+    # re-serialization; the hit/miss header is best-effort under concurrency
+    hits_before = _fetch_images.cache_info().hits
+    body = await _fetch_images(q, limit)
+    cache_state = "HIT" if _fetch_images.cache_info().hits > hits_before else "MISS"
+    return _cacheable_json(request, body, headers={"X-Cache": cache_state})
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Import string (not the app instance) so multi-worker mode works;
+    # uvloop + httptools shave per-request parsing/scheduling overhead
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=max(2, os.cpu_count() or 1),
+    )